@@ -1,7 +1,7 @@
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
 from trytond.pool import Pool
-from . import product
+from . import ir, product
 
 
 def register():
@@ -10,4 +10,5 @@ def register():
         product.Template,
         product.Product,
         product.ProductRawProduct,
+        ir.Cron,
         module='product_raw_variant', type_='model')
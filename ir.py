@@ -0,0 +1,17 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+from trytond.pool import PoolMeta
+
+
+class Cron(metaclass=PoolMeta):
+    __name__ = 'ir.cron'
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        cls.method.selection.append(
+            ('product.template|backfill_raw_products',
+                "Create Missing Raw Variants"))
+        cls.method.selection.append(
+            ('product.product|repair_raw_products',
+                "Repair Raw Variants"))
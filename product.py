@@ -1,13 +1,31 @@
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
 import logging
+import time
+from collections import defaultdict
+from concurrent import futures
+from functools import partial, reduce, wraps
+from itertools import islice
+from multiprocessing import cpu_count
+from weakref import WeakKeyDictionary
 
-from trytond.model import ModelSQL, fields, Unique
+from sql import Literal, Null, Window
+from sql.conditionals import Case, Coalesce
+from sql.functions import CurrentTimestamp, RowNumber, Substring
+from sql.operators import Concat
+
+from trytond import backend
+from trytond.cache import Cache
+from trytond.config import config
+from trytond.model import Index, ModelSQL, fields, Unique
+from trytond.model.exceptions import SQLConstraintError
 from trytond.pool import Pool, PoolMeta
 from trytond.pyson import And, Bool, Eval, Or
 from trytond.transaction import Transaction
 from trytond.i18n import gettext
 from trytond.exceptions import UserError
+from trytond.tools import grouped_slice, reduce_ids
+from trytond.worker import initializer
 
 
 __all__ = ['Configuration', 'Template', 'Product', 'ProductRawProduct']
@@ -17,6 +35,157 @@ STATES = {
     }
 DEPENDS = ['active', 'has_raw_products']
 logger = logging.getLogger(__name__)
+PROFILE = config.getboolean('product_raw_variant', 'profile', default=False)
+_query_counters = {}
+_transaction_caches = WeakKeyDictionary()
+
+
+def clear_cache(Model):
+    "Clean the record caches of Model after an update in SQL"
+    transaction = Transaction()
+    transaction.counter += 1
+    for cache in transaction.cache.values():
+        if Model.__name__ in cache:
+            cache[Model.__name__].clear()
+
+
+class _TransactionCache(dict):
+    "Mapping kept for the duration of a transaction"
+    __slots__ = ('__weakref__',)
+
+
+def transaction_cache(name):
+    """Return the mapping name of the current transaction
+
+    The mapping is not limited in size and it is cleared on commit and
+    rollback.
+    """
+    transaction = Transaction()
+    caches = _transaction_caches.setdefault(transaction, {})
+    cache = caches.get(name)
+    if cache is None:
+        cache = caches[name] = _TransactionCache()
+        transaction.cache[name] = cache
+    return cache
+
+
+class _Counter(object):
+    queries = 0
+
+
+class _CountingCursor(object):
+    "Cursor proxy which counts the statements executed"
+
+    def __init__(self, cursor, counters):
+        self._cursor = cursor
+        self._counters = counters
+
+    def execute(self, *args, **kwargs):
+        for counter in self._counters:
+            counter.queries += 1
+        return self._cursor.execute(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __enter__(self):
+        self._cursor.__enter__()
+        return self
+
+    def __exit__(self, *args):
+        return self._cursor.__exit__(*args)
+
+
+class _CountingConnection(object):
+    "Connection proxy whose cursors count the statements executed"
+
+    def __init__(self, connection, counters):
+        self._connection = connection
+        self._counters = counters
+
+    def cursor(self, *args, **kwargs):
+        return _CountingCursor(
+            self._connection.cursor(*args, **kwargs), self._counters)
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+
+def measured(name):
+    """Log the records, the SQL statements and the duration of the method
+
+    It is enabled by the profile option of the product_raw_variant section
+    of the configuration or by the product_raw_variant_profile context key.
+    The statements are counted on the cursors of the transaction connection
+    which is restored when the outermost measure ends.
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(cls, records, *args, **kwargs):
+            transaction = Transaction()
+            if not (PROFILE
+                    or transaction.context.get('product_raw_variant_profile')):
+                return func(cls, records, *args, **kwargs)
+
+            connection = transaction.connection
+            counters = _query_counters.setdefault(id(transaction), [])
+            if not counters:
+                transaction.connection = _CountingConnection(
+                    connection, counters)
+            counter = _Counter()
+            counters.append(counter)
+            start = time.perf_counter()
+            try:
+                return func(cls, records, *args, **kwargs)
+            finally:
+                duration = time.perf_counter() - start
+                counters.remove(counter)
+                if not counters:
+                    del _query_counters[id(transaction)]
+                    transaction.connection = connection
+                logger.info("%s: %d records, %d queries, %.6fs",
+                    name, len(records), counter.queries, duration,
+                    extra={'product_raw_variant': {
+                            'name': name,
+                            'records': len(records),
+                            'queries': counter.queries,
+                            'duration': duration,
+                            }})
+        return wrapper
+    return decorator
+
+
+def _create_missing_raw_products(
+        database_name, user, context, template_ids):
+    """Create the missing raw variants of the templates in a new transaction
+
+    Return the template ids, the number of raw variants created and the
+    error message if the transaction failed.
+    """
+    try:
+        with Transaction(new=True).start(
+                database_name, user, context=context):
+            Template = Pool().get('product.template')
+            raw_products = Template.bulk_create_missing_raw_products(
+                Template.browse(template_ids))
+            return template_ids, len(raw_products), None
+    except Exception as exception:
+        logger.warning("Fail to create the raw products of templates %s",
+            template_ids, exc_info=True)
+        return template_ids, 0, getattr(exception, 'message', str(exception))
+
+
+class _LinkOne2One(fields.One2One):
+    "One2One between main and raw variants read from the cached links"
+
+    def get(self, ids, model, name, values=None):
+        ProductRawProduct = Pool().get('product.product-product.raw_product')
+        index = 0 if self.origin == 'product' else 1
+        links = ProductRawProduct.get_links(ids)
+        return {i: links[i][index] for i in ids}
 
 
 class Configuration(metaclass=PoolMeta):
@@ -27,6 +196,63 @@ class Configuration(metaclass=PoolMeta):
         help='This prefix will be added to main variant code')
     prefix_sufix_separator = fields.Char('Prefis Sufix Separator',
         help='This separator will be added between prefix and sufix')
+    _prefixes_cache = Cache('product.configuration.raw_variant_prefixes',
+        context=False)
+
+    @classmethod
+    def get_raw_variant_prefixes(cls):
+        "Return the raw variant prefix, main variant prefix and separator"
+        prefixes = cls._prefixes_cache.get(None)
+        if prefixes is None:
+            configuration = cls(1)
+            prefixes = cls._prefixes_cache.set(None, (
+                    configuration.raw_product_prefix,
+                    configuration.main_product_prefix,
+                    configuration.prefix_sufix_separator,
+                    ))
+        return prefixes
+
+    @classmethod
+    def on_write(cls, configurations, values):
+        callbacks = super().on_write(configurations, values)
+        if any(getattr(c, f) != values[f]
+                for c in configurations
+                for f in cls._raw_variant_prefix_fields() if f in values):
+            callbacks.append(cls._sync_raw_codes)
+        return callbacks
+
+    @classmethod
+    def on_modification(cls, mode, configurations, field_names=None):
+        pool = Pool()
+        Template = pool.get('product.template')
+        super().on_modification(mode, configurations, field_names=field_names)
+        cls._prefixes_cache.clear()
+        Template._product_defaults_cache.clear()
+        if mode == 'create' and any(getattr(c, f)
+                for c in configurations
+                for f in cls._raw_variant_prefix_fields()):
+            cls._sync_raw_codes()
+
+    @classmethod
+    def _raw_variant_prefix_fields(cls):
+        return {'raw_product_prefix', 'main_product_prefix',
+            'prefix_sufix_separator'}
+
+    @classmethod
+    def _sync_raw_codes(cls):
+        "Recode the variants with raw variants in batches from the queue"
+        pool = Pool()
+        Product = pool.get('product.product')
+        product = Product.__table__()
+        cursor = Transaction().connection.cursor()
+
+        cursor.execute(*product.select(product.id,
+                where=product.has_raw_products == Literal(True),
+                order_by=[product.id.asc]))
+        products = Product.browse([i for i, in cursor])
+        if products:
+            with Transaction().set_context(queue_batch=True):
+                Product.__queue__.sync_raw_code(products)
 
 
 class Template(metaclass=PoolMeta):
@@ -42,12 +268,13 @@ class Template(metaclass=PoolMeta):
                 ], states=STATES, context={
                 'no_create_raw_products': True,
                 }),
-        'get_main_products', setter='set_main_products')
+        'get_products', setter='set_main_products', searcher='search_products')
     raw_products = fields.Function(fields.Many2Many('product.product',
             'template', None, 'Raw Variants', domain=[
                 ('is_raw_product', '=', True),
                 ], states=STATES),
-        'get_raw_products')
+        'get_products', searcher='search_products')
+    _product_defaults_cache = Cache('product.template.product_defaults')
 
     @classmethod
     def __setup__(cls):
@@ -63,10 +290,68 @@ class Template(metaclass=PoolMeta):
     def default_has_raw_products():
         return False
 
-    def get_main_products(self, name):
-        if not self.has_raw_products:
-            return []
-        return [p.id for p in self.products if not p.is_raw_product]
+    @classmethod
+    def get_products(cls, templates, names):
+        """Return the ids of the main and raw variants of the templates
+
+        The product_raw_variant_offset and product_raw_variant_limit context
+        keys page the variants of each template, ordered by id.
+        """
+        pool = Pool()
+        Product = pool.get('product.product')
+        product = Product.__table__()
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        offset = transaction.context.get('product_raw_variant_offset') or 0
+        limit = transaction.context.get('product_raw_variant_limit')
+
+        result = {n: {t.id: [] for t in templates} for n in names}
+        where = Literal(True)
+        if transaction.context.get('active_test', True):
+            where &= product.active == Literal(True)
+        is_raw_product = Coalesce(product.is_raw_product, Literal(False))
+        template_ids = [t.id for t in templates if t.has_raw_products]
+        for sub_ids in grouped_slice(template_ids):
+            query = product.select(
+                product.template, is_raw_product.as_('is_raw_product'),
+                product.id,
+                RowNumber(window=Window([product.template, is_raw_product],
+                        order_by=[product.id.asc])).as_('number'),
+                where=reduce_ids(product.template, sub_ids) & where)
+            where_number = query.number > offset
+            if limit is not None:
+                where_number &= query.number <= offset + limit
+            cursor.execute(*query.select(
+                    query.template, query.is_raw_product, query.id,
+                    where=where_number,
+                    order_by=[query.template, query.id]))
+            for template_id, is_raw_product_, product_id in cursor:
+                name = 'raw_products' if is_raw_product_ else 'main_products'
+                if name in result:
+                    result[name][template_id].append(product_id)
+        return result
+
+    @classmethod
+    def search_products(cls, name, clause):
+        "Search on the products filtered like main_products or raw_products"
+        filter_ = [
+            ('has_raw_products', '=', True),
+            ('is_raw_product', '=', name == 'raw_products'),
+            ]
+        _, operator, value = clause[:3]
+        _, _, target_name = clause[0].partition('.')
+        if operator in {'where', 'not where'}:
+            return [('products', operator, [filter_, value])]
+        if value is None:
+            return [('products', 'not where' if operator == '=' else 'where',
+                    filter_)]
+        if not target_name:
+            target_name = 'rec_name' if isinstance(value, str) else 'id'
+        domain = [('products', 'where',
+                [filter_, (target_name,) + tuple(clause[1:])])]
+        if operator.startswith('!') or operator.startswith('not '):
+            domain = ['OR', domain, ('products', 'not where', filter_)]
+        return domain
 
     @classmethod
     def set_main_products(cls, templates, name, value):
@@ -76,74 +361,112 @@ class Template(metaclass=PoolMeta):
                 'products': value,
                 })
 
-    def get_raw_products(self, name):
-        if not self.has_raw_products:
-            return []
-        return [p.id for p in self.products if p.is_raw_product]
-
     @fields.depends('has_raw_products', 'products')
     def on_change_has_raw_products(self):
-        Product = Pool().get('product.product')
         if self.has_raw_products:
             self.products = []
         elif not self.products:
-            fields_names = [f for f in Product._fields.keys()
-                if f not in ('id', 'create_uid', 'create_date',
-                    'write_uid', 'write_date')]
-            self.products = [Product.default_get(fields_names)]
+            self.products = [self._product_defaults()]
+
+    @classmethod
+    def _product_defaults(cls):
+        "Return the cached default values of a new variant"
+        Product = Pool().get('product.product')
+        fields_names = Product._default_fields_names
+        key = (Transaction().user, fields_names)
+        values = cls._product_defaults_cache.get(key)
+        if values is None:
+            values = Product.default_get(list(fields_names))
+            cls._product_defaults_cache.set(key, values)
+        return values.copy()
 
     @classmethod
+    @measured('product.template.validate')
     def validate(cls, templates):
+        pool = Pool()
+        Product = pool.get('product.product')
         super(Template, cls).validate(templates)
-        for template in templates:
-            for product in template.products:
-                product.check_raw_product()
+        Product.check_raw_products(Product.search([
+                    ('template', 'in', [t.id for t in templates]),
+                    ]))
 
     def update_variant_product(self, products, variant):
         # Compatibility with product_variant module (extras_depend)
         Config = Pool().get('product.configuration')
-        config = Config(1)
-
-        def _super_call_with_prefix(products_sublist, prefix):
-            if not products_sublist or not prefix:
-                return
-            with Transaction().set_context(product_raw_variant_prefix=prefix):
-                super(Template, self).update_variant_product(products_sublist,
-                    variant)
-                for product in products_sublist:
-                    products.remove(product)
+        raw_product_prefix, main_product_prefix, _ = (
+            Config.get_raw_variant_prefixes())
 
+        main_products, raw_products, other_products = [], [], []
         if self.has_raw_products:
-            if config.main_product_prefix:
-                main_products = tuple(p for p in products
-                    if not p.is_raw_product)
-                _super_call_with_prefix(main_products,
-                    config.main_product_prefix)
-            if config.raw_product_prefix:
-                raw_products = tuple(p for p in products if p.is_raw_product)
-                _super_call_with_prefix(raw_products,
-                    config.raw_product_prefix)
+            for product in products:
+                if product.is_raw_product and raw_product_prefix:
+                    raw_products.append(product)
+                elif not product.is_raw_product and main_product_prefix:
+                    main_products.append(product)
+                else:
+                    other_products.append(product)
+        else:
+            other_products = products
 
-        if products:
-            super(Template, self).update_variant_product(products,
+        for products_sublist, prefix in [
+                (main_products, main_product_prefix),
+                (raw_products, raw_product_prefix),
+                ]:
+            if products_sublist:
+                with Transaction().set_context(
+                        product_raw_variant_prefix=prefix):
+                    super(Template, self).update_variant_product(
+                        products_sublist, variant)
+        if other_products:
+            super(Template, self).update_variant_product(other_products,
                 variant)
 
     @classmethod
     def create(cls, vlist):
         new_templates = super(Template, cls).create(vlist)
-        for template in new_templates:
-            if  template.has_raw_products:
-                template.create_missing_raw_products()
+        cls.bulk_create_missing_raw_products(new_templates)
         return new_templates
 
     @classmethod
+    def write(cls, *args):
+        pool = Pool()
+        Product = pool.get('product.product')
+        product = Product.__table__()
+        cursor = Transaction().connection.cursor()
+
+        # Update the variants before the validation of the templates
+        actions = iter(args)
+        to_backfill = []
+        for templates, values in zip(actions, actions):
+            if 'has_raw_products' not in values:
+                continue
+            if values['has_raw_products']:
+                to_backfill.extend(t for t in templates
+                    if not t.has_raw_products)
+            for sub_ids in grouped_slice([t.id for t in templates]):
+                cursor.execute(*product.update(
+                        [product.has_raw_products],
+                        [Literal(bool(values['has_raw_products']))],
+                        where=reduce_ids(product.template, sub_ids)))
+            clear_cache(Product)
+        super(Template, cls).write(*args)
+
+        if to_backfill:
+            # Create the raw variants by committed batches from the queue
+            cls.__queue__.backfill_raw_products(
+                list(dict.fromkeys(to_backfill)))
+
+    @classmethod
+    @measured('product.template.delete')
     def delete(cls, templates):
         pool = Pool()
         Product = pool.get('product.product')
-        to_delete = []
-        for template in templates:
-            if template.has_raw_products:
-                to_delete.extend(list(template.main_products))
+        with Transaction().set_context(active_test=False):
+            to_delete = Product.search([
+                    ('template', 'in', [t.id for t in templates]),
+                    ('has_raw_products', '=', True),
+                    ('is_raw_product', '=', False),
+                    ])
         if to_delete:
             Product.delete(to_delete)
         super(Template, cls).delete(templates)
@@ -159,50 +482,186 @@ class Template(metaclass=PoolMeta):
         raw_defaults.setdefault('products', [])
         new_raw = (super(Template, cls).copy(raw_templates, raw_defaults)
             if raw_templates else [])
+        if (new_raw and 'products' not in defaults
+                and Transaction().context.get('copy_raw_products')):
+            cls.copy_raw_products(raw_templates, new_raw, default={
+                    k[len('products.'):]: v for k, v in defaults.items()
+                    if k.startswith('products.')})
         new_main = (super(Template, cls).copy(not_raw_templates, defaults)
             if not_raw_templates else [])
         return new_raw + new_main
 
+    @classmethod
+    def copy_raw_products(cls, templates, new_templates, default=None):
+        """Copy the main and raw variants of templates to new_templates
+
+        By default the copies keep the suffix code. The variants are copied
+        at once and the links between them are created in bulk.
+        """
+        pool = Pool()
+        Configuration = pool.get('product.configuration')
+        Product = pool.get('product.product')
+        ProductRawProduct = pool.get('product.product-product.raw_product')
+
+        template_map = {t.id: n.id for t, n in zip(templates, new_templates)}
+
+        def template(data):
+            return template_map[data['template']]
+
+        main_products = Product.search([
+                ('template', 'in', list(template_map.keys())),
+                ('is_raw_product', '=', False),
+                ], order=[('id', 'ASC')])
+        default = default.copy() if default else {}
+        if main_products and 'suffix_code' not in default:
+            _, main_product_prefix, _ = (
+                Configuration.get_raw_variant_prefixes())
+            # The code of the copies would be the same as the original
+            if main_product_prefix:
+                raise UserError(gettext(
+                        'product_raw_variant.msg_copy_main_product_prefix',
+                        template=main_products[0].template.rec_name,
+                        prefix=main_product_prefix))
+        links = Product.get_raw_links(main_products)
+        linked_products = [p for p in main_products if links[p.id][0]]
+        raw_products = Product.browse(
+            [links[p.id][0] for p in linked_products])
+        default.setdefault('suffix_code', lambda data: data['suffix_code'])
+        default.update({
+                'template': template,
+                'raw_product': None,
+                'main_product': None,
+                })
+        with Transaction().set_context(no_create_raw_products=True):
+            new_products = Product.copy(
+                main_products + raw_products, default=default)
+            new_main_products = new_products[:len(main_products)]
+            new_raw_products = new_products[len(main_products):]
+            copies = dict(zip(main_products, new_main_products))
+            ProductRawProduct.create([{
+                        'product': copies[product].id,
+                        'raw_product': new_raw_product.id,
+                        } for product, new_raw_product in zip(
+                        linked_products, new_raw_products)])
+        return new_products
+
     def create_missing_raw_products(self):
+        raw_products = self.bulk_create_missing_raw_products([self])
+        return raw_products or {}
+
+    @classmethod
+    @measured('product.template.bulk_create_missing_raw_products')
+    def bulk_create_missing_raw_products(cls, templates):
+        "Create the missing raw variants of the templates in bulk"
         Product = Pool().get('product.product')
 
-        logger.info("Start create missing raw products")
+        templates = [t for t in templates if t.has_raw_products]
+        if not templates:
+            return []
+        products = Product.search([
+                ('template', 'in', [t.id for t in templates]),
+                ('is_raw_product', '=', False),
+                ('raw_product', '=', None),
+                ], order=[('id', 'ASC')])
+        return Product.create_raw_products(products)
+
+    @classmethod
+    def backfill_raw_products(cls, templates=None, batch_size=None):
+        """Create the missing raw variants by batches
 
-        products_missing_raw_variant = [p for p in self.products
-            if not p.raw_product and not p.is_raw_product]
-        if not products_missing_raw_variant:
-            return {}
+        Each batch is committed so the backfill can be resumed after a failure.
+        Return the number of raw variants created.
+        """
+        pool = Pool()
+        Product = pool.get('product.product')
+        transaction = Transaction()
 
-        with Transaction().set_context(no_create_raw_products=True):
-            logger.info("copying %d products"
-                % len(products_missing_raw_variant))
-            missing_raw_products = Product.copy(products_missing_raw_variant,
-                default={
-                    'has_raw_products': True,
-                    'is_raw_product': True,
-                    })
-            for raw_product, product in zip(missing_raw_products,
-                    products_missing_raw_variant):
-                product.raw_product = raw_product
-                product.save()
+        if batch_size is None:
+            batch_size = transaction.database.IN_MAX
+        domain = [
+            ('has_raw_products', '=', True),
+            ('is_raw_product', '=', False),
+            ('raw_product', '=', None),
+            ]
+        if templates is not None:
+            domain.append(('template', 'in', [t.id for t in templates]))
+        total = Product.search_count(domain)
+        count = 0
+        while True:
+            products = Product.search(domain, order=[('id', 'ASC')],
+                limit=batch_size)
+            if not products:
+                break
+            count += len(Product.create_raw_products(products))
+            transaction.commit()
+            logger.info("Created %d/%d missing raw products", count, total)
+        return count
+
+    @classmethod
+    def generate_raw_products(cls, templates=None, processes=None,
+            chunk_size=None):
+        """Create the missing raw variants by chunks of templates in parallel
 
-        logger.info("End create missing raw products")
+        Each chunk is run by a worker process in its own transaction so the
+        templates must be committed. Return a report with the number of
+        templates, the number of raw variants created and the errors as a
+        list of template ids and message.
+        """
+        transaction = Transaction()
+        database_name = transaction.database.name
 
-        return missing_raw_products
+        if templates is None:
+            templates = cls.search([
+                    ('has_raw_products', '=', True),
+                    ], order=[('id', 'ASC')])
+        if chunk_size is None:
+            chunk_size = transaction.database.IN_MAX
+        if processes is None:
+            try:
+                processes = cpu_count()
+            except NotImplementedError:
+                processes = 1
+        template_ids = [t.id for t in templates]
+        chunks = [template_ids[i:i + chunk_size]
+            for i in range(0, len(template_ids), chunk_size)]
+        func = partial(_create_missing_raw_products,
+            database_name, transaction.user, transaction.context)
+        # A memory database is not shared between processes
+        if (processes > 1 and len(chunks) > 1
+                and database_name != ':memory:'):
+            with futures.ProcessPoolExecutor(
+                    max_workers=min(processes, len(chunks)),
+                    initializer=initializer,
+                    initargs=([database_name], False)) as executor:
+                results = list(executor.map(func, chunks))
+        else:
+            results = [func(c) for c in chunks]
+
+        report = {
+            'templates': len(template_ids),
+            'created': 0,
+            'errors': [],
+            }
+        for chunk_ids, created, error in results:
+            report['created'] += created
+            if error:
+                report['errors'].append((chunk_ids, error))
+        logger.info("Created %d raw products of %d templates with %d errors",
+            report['created'], report['templates'], len(report['errors']))
+        return report
 
 
 class Product(metaclass=PoolMeta):
     __name__ = 'product.product'
 
-    has_raw_products = fields.Function(fields.Boolean('Has Raw Variants'),
-        'on_change_with_has_raw_products', searcher='search_has_raw_products')
+    has_raw_products = fields.Boolean('Has Raw Variants', readonly=True)
     is_raw_product = fields.Boolean('Is Raw Variant', readonly=True,
         states={
             'invisible': And(~Eval('_parent_template',
                     {}).get('has_raw_products', False),
                 ~Eval('has_raw_products', False)),
             })
-    raw_product = fields.One2One('product.product-product.raw_product',
+    raw_product = _LinkOne2One('product.product-product.raw_product',
         'product', 'raw_product', 'Raw Variant', readonly=True,
         domain=[
             ('template', '=', Eval('template')),
@@ -217,7 +676,7 @@ class Product(metaclass=PoolMeta):
                     ~Eval('has_raw_products', False)),
                 Eval('is_raw_product', False)),
             })
-    main_product = fields.One2One('product.product-product.raw_product',
+    main_product = _LinkOne2One('product.product-product.raw_product',
         'raw_product', 'product', 'Main Variant', readonly=True, states={
             'invisible': Or(
                 And(~Eval('_parent_template', {}).get('has_raw_products',
@@ -226,116 +685,485 @@ class Product(metaclass=PoolMeta):
                 ~Bool(Eval('is_raw_product'))),
             })
 
+    @classmethod
+    def __setup__(cls):
+        super(Product, cls).__setup__()
+        t = cls.__table__()
+        cls._sql_indexes.update({
+                Index(t,
+                    (t.has_raw_products, Index.Equality(cardinality='low'))),
+                Index(t, (t.template, Index.Range()),
+                    where=t.is_raw_product == Literal(True)),
+                })
+
+    @classmethod
+    def __post_setup__(cls):
+        super(Product, cls).__post_setup__()
+        cls._default_fields_names = tuple(f for f in cls._fields
+            if f not in ('id', 'create_uid', 'create_date',
+                'write_uid', 'write_date'))
+
+    @classmethod
+    def __register__(cls, module_name):
+        pool = Pool()
+        Template = pool.get('product.template')
+        table = cls.__table__()
+        template = Template.__table__()
+        cursor = Transaction().connection.cursor()
+        table_h = cls.__table_handler__(module_name)
+
+        has_raw_products_exist = table_h.column_exist('has_raw_products')
+
+        super(Product, cls).__register__(module_name)
+
+        # Migration from 7.6: has_raw_products is stored
+        if not has_raw_products_exist:
+            cursor.execute(*table.update(
+                    [table.has_raw_products], [Literal(True)],
+                    where=table.template.in_(template.select(template.id,
+                            where=template.has_raw_products
+                            == Literal(True)))))
+
+    @staticmethod
+    def default_has_raw_products():
+        return False
+
     @fields.depends('template', '_parent_template.has_raw_products')
     def on_change_with_has_raw_products(self, name=None):
         return self.template and self.template.has_raw_products or False
 
     @classmethod
-    def search_has_raw_products(cls, name, clause):
-        return [('template.has_raw_products', ) + tuple(clause[1:])]
+    def _set_has_raw_products(cls, values):
+        Template = Pool().get('product.template')
+        if values.get('template') is not None:
+            values['has_raw_products'] = bool(
+                Template(values['template']).has_raw_products)
+        return values
 
     @classmethod
+    @measured('product.product.sync_code')
     def sync_code(cls, products):
-        Configuration = Pool().get('product.configuration')
-        config = Configuration(1)
-
-        to_super = []
-        to_save = []
-        for product in products:
-            # has_raw_product code from raw_product_prefix or main_product_prefix
-            if not product.template.has_raw_products:
-                to_super.append(product)
-                continue
-            code = None
-            if product.is_raw_product and config.raw_product_prefix:
-                code = ''.join(filter(None, [
-                            config.raw_product_prefix, product.prefix_code,
-                            config.prefix_sufix_separator,
-                            product.suffix_code]))
-            elif config.main_product_prefix:
-                code = ''.join(filter(None, [
-                            config.main_product_prefix,
-                            config.prefix_sufix_separator,
-                            product.suffix_code]))
-            else:
-                code = ''.join(filter(None, [
-                            product.prefix_code,
-                            config.prefix_sufix_separator,
-                            product.suffix_code]))
-            prefix = Transaction().context.get('product_raw_variant_prefix')
-            if prefix and not code.startswith(prefix):
-                code = prefix + code
-            if code != product.code:
-                product.code = code
-                to_save.append(product)
-        cls.save(to_save)
+        to_super = [p for p in products if not p.has_raw_products]
+        cls.sync_raw_code([p for p in products if p.has_raw_products])
         if to_super:
             super().sync_code(to_super)
 
     @classmethod
+    def _raw_code_column(cls, table):
+        "Return the SQL expression of the code of products with raw variants"
+        pool = Pool()
+        Configuration = pool.get('product.configuration')
+        Template = pool.get('product.template')
+        template = Template.__table__()
+        raw_product_prefix, main_product_prefix, separator = (
+            Configuration.get_raw_variant_prefixes())
+
+        def concat(*values):
+            return reduce(Concat, [v for v in values if v is not None])
+
+        prefix_code = Coalesce(template.select(template.code,
+                where=template.id == table.template), '')
+        separator = separator or None
+        suffix_code = Coalesce(table.suffix_code, '')
+        if main_product_prefix:
+            code = concat(main_product_prefix, separator, suffix_code)
+        else:
+            code = concat(prefix_code, separator, suffix_code)
+        if raw_product_prefix:
+            code = Case((table.is_raw_product == Literal(True),
+                    concat(raw_product_prefix, prefix_code, separator,
+                        suffix_code)),
+                else_=code)
+        prefix = Transaction().context.get('product_raw_variant_prefix')
+        if prefix:
+            code = Case((Substring(code, 1, len(prefix)) == prefix, code),
+                else_=Concat(prefix, code))
+        return code
+
+    @classmethod
+    def sync_raw_code(cls, products):
+        "Set the code of products with raw variants using bulk UPDATEs"
+        table = cls.__table__()
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+
+        if not products:
+            return
+        code = cls._raw_code_column(table)
+        for sub_products in grouped_slice(products):
+            sub_ids = [p.id for p in sub_products]
+            try:
+                cursor.execute(*table.update(
+                        [table.code, table.write_uid, table.write_date],
+                        [code, transaction.user, CurrentTimestamp()],
+                        where=reduce_ids(table.id, sub_ids)
+                        & ((table.code != code) | (table.code == Null))))
+            except backend.DatabaseIntegrityError as exception:
+                raise SQLConstraintError(
+                    gettext('product.msg_product_code_unique')
+                    ) from exception
+            cls._check_code_unique(sub_ids)
+        clear_cache(cls)
+
+    @classmethod
+    def _check_code_unique(cls, ids):
+        "Check the code of the active products when the database does not"
+        table = cls.__table__()
+        other = cls.__table__()
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+
+        constraints = {n: c for n, c, _ in cls._sql_constraints}
+        if ('code_exclude' not in constraints
+                or transaction.database.has_constraint(
+                    constraints['code_exclude'])):
+            return
+        cursor.execute(*table.join(other,
+                condition=(table.code == other.code)
+                & (table.id != other.id)
+                ).select(table.id,
+                where=reduce_ids(table.id, ids)
+                & (table.active == Literal(True))
+                & (table.code != '')
+                & (other.active == Literal(True)),
+                limit=1))
+        if cursor.fetchone():
+            raise SQLConstraintError(
+                gettext('product.msg_product_code_unique'))
+
+    @classmethod
+    @measured('product.product.validate')
     def validate(cls, products):
         super(Product, cls).validate(products)
-        for product in products:
-            product.check_raw_product()
+        cls.check_raw_products(products)
 
     def check_raw_product(self):
-        if (not self.has_raw_products and
-                (self.raw_product or self.main_product)):
-            raise UserError(gettext(
-                'product_raw_variant.unexpected_raw_or_main_product',
-                product=self.rec_name))
-        if not self.has_raw_products:
-            return
-        if self.is_raw_product and self.raw_product:
-            raise UserError(gettext(
-                'product_raw_variant.unexpected_raw_product',
-                product=self.rec_name))
-        if not self.is_raw_product and self.main_product:
-            raise UserError(gettext(
-                'product_raw_variant.unexpected_main_product',
-                product=self.rec_name))
+        self.check_raw_products([self])
+
+    @classmethod
+    def check_raw_products(cls, products):
+        pool = Pool()
+        ProductRawProduct = pool.get('product.product-product.raw_product')
+        table = cls.__table__()
+        main = ProductRawProduct.__table__()
+        raw = ProductRawProduct.__table__()
+        cursor = Transaction().connection.cursor()
+
+        has_raw_products = Coalesce(table.has_raw_products, Literal(False))
+        is_raw_product = Coalesce(table.is_raw_product, Literal(False))
+        has_raw_product = main.id != Null
+        has_main_product = raw.id != Null
+        query = table.join(main, 'LEFT',
+            condition=main.product == table.id
+            ).join(raw, 'LEFT',
+            condition=raw.raw_product == table.id)
+
+        errors = {}
+        for sub_products in grouped_slice(products):
+            sub_ids = [p.id for p in sub_products]
+            cursor.execute(*query.select(
+                    table.id, has_raw_products, is_raw_product,
+                    has_raw_product, has_main_product,
+                    where=reduce_ids(table.id, sub_ids)
+                    & ((~has_raw_products
+                            & (has_raw_product | has_main_product))
+                        | (has_raw_products & is_raw_product
+                            & has_raw_product)
+                        | (has_raw_products & ~is_raw_product
+                            & has_main_product))))
+            for (product_id, has_raw_products_, is_raw_product_,
+                    has_raw_product_, has_main_product_) in cursor:
+                if not has_raw_products_:
+                    errors[product_id] = (
+                        'product_raw_variant.unexpected_raw_or_main_product')
+                elif is_raw_product_:
+                    errors[product_id] = (
+                        'product_raw_variant.unexpected_raw_product')
+                else:
+                    errors[product_id] = (
+                        'product_raw_variant.unexpected_main_product')
+            if errors:
+                break
+        for product in products:
+            if product.id in errors:
+                raise UserError(gettext(errors[product.id],
+                        product=product.rec_name))
 
     @classmethod
     def create(cls, vlist):
         create_raw_products = not Transaction().context.get(
             'no_create_raw_products', False)
+        vlist = [cls._set_has_raw_products(v.copy()) for v in vlist]
         new_products = super(Product, cls).create(vlist)
         if not create_raw_products:
             return new_products
 
+        links = cls.get_raw_links(new_products)
         products_missing_raw_product = [p for p in new_products
             if (p.has_raw_products and not p.is_raw_product and
-                not p.raw_product)]
-        for product in products_missing_raw_product:
-            product.create_raw_product()
+                not links[p.id][0])]
+        cls.create_raw_products(products_missing_raw_product)
         return new_products
 
+    @classmethod
+    def write(cls, *args):
+        sync_fields = cls._raw_product_sync_fields()
+        actions = iter(args)
+        args = []
+        to_sync = []
+        for products, values in zip(actions, actions):
+            if 'template' in values:
+                values = cls._set_has_raw_products(values.copy())
+            args.extend((products, values))
+            sync_values = {f: v for f, v in values.items()
+                if f in sync_fields}
+            if sync_values:
+                to_sync.append((products, sync_values))
+        if to_sync:
+            # Written together to be validated with their main variants
+            args.extend(cls._raw_products_to_sync(to_sync))
+        super(Product, cls).write(*args)
+
+    @classmethod
+    def _raw_product_sync_fields(cls):
+        "Return the fields propagated from the main variant to its raw variant"
+        return {'suffix_code', 'template'}
+
+    @classmethod
+    def _raw_products_to_sync(cls, to_sync):
+        """Return the write arguments to propagate to the raw variants
+
+        to_sync is a list of (products, values) written on main variants.
+        Only the raw variants with a different value are returned, grouped
+        by values.
+        """
+        main_products = [p for products, _ in to_sync for p in products]
+        links = cls.get_raw_links(main_products)
+        fields_names = {f for _, values in to_sync for f in values}
+        raw_ids = list({links[p.id][0] for p in main_products
+                if links[p.id][0]})
+        raw_values = {}
+        for sub_ids in grouped_slice(raw_ids):
+            raw_values.update((v['id'], v) for v in cls.read(
+                    list(sub_ids), fields_names=list(fields_names)))
+
+        to_write = defaultdict(list)
+        for products, values in to_sync:
+            raw_ids = {links[p.id][0] for p in products if links[p.id][0]}
+            to_write[tuple(sorted(values.items()))].extend(
+                r for r in raw_ids
+                if any(raw_values[r][f] != v for f, v in values.items()))
+        args = []
+        for values, raw_products in to_write.items():
+            if raw_products:
+                args.extend((cls.browse(raw_products), dict(values)))
+        return args
+
     def create_raw_product(self):
-        logger.info('Create raw product: %s.' % (self.rec_name))
+        raw_product, = self.create_raw_products([self])
+        return raw_product
+
+    @classmethod
+    @measured('product.product.create_raw_products')
+    def create_raw_products(cls, products):
+        """Create the raw variant of each product and link them in bulk.
+
+        The codes are computed by sync_code when the copies are created.
+        """
+        pool = Pool()
+        ProductRawProduct = pool.get('product.product-product.raw_product')
+
+        if not products:
+            return []
+        logger.info('Create %d raw products.', len(products))
 
         with Transaction().set_context(no_create_raw_products=True):
-            raw_product, = self.copy([self], default={
-                    'suffix_code': self.suffix_code,
+            raw_products = cls.copy(products, default={
+                    'suffix_code': lambda data: data['suffix_code'],
                     'is_raw_product': True,
-                    'main_product': self.id,
+                    'raw_product': None,
+                    'main_product': None,
                     })
-            self.sync_code([raw_product])
-        return raw_product
+            ProductRawProduct.create([{
+                        'product': product.id,
+                        'raw_product': raw_product.id,
+                        } for product, raw_product in zip(products,
+                        raw_products)])
+        cls.validate(products)
+        return raw_products
 
     @classmethod
+    @measured('product.product.delete')
     def delete(cls, products):
-        to_delete = []
+        pool = Pool()
+        ProductRawProduct = pool.get('product.product-product.raw_product')
+        links = cls.get_raw_links(products)
+        ids = {p.id for p in products}
+        to_delete = list(products)
         for product in products:
-            if product.has_raw_products:
-                if product.raw_product:
-                    to_delete.append(product.raw_product)
-                elif product.main_product:
-                    raise UserError(gettext(
-                        'product_raw_variant.delete_raw_products_forbidden',
-                            raw_product=product.rec_name,
-                            product=product.main_product))
-            to_delete.append(product)
-        super(Product, cls).delete(to_delete)
+            raw_product_id, main_product_id = links[product.id]
+            if raw_product_id and raw_product_id not in ids:
+                to_delete.append(cls(raw_product_id))
+            elif main_product_id and main_product_id not in ids:
+                raise UserError(gettext(
+                    'product_raw_variant.delete_raw_products_forbidden',
+                        raw_product=product.rec_name,
+                        product=cls(main_product_id).rec_name))
+        for sub_products in grouped_slice(to_delete):
+            super(Product, cls).delete(list(sub_products))
+        # The links are deleted on cascade by the database
+        ProductRawProduct._links_cache().clear()
+
+    @classmethod
+    def get_raw_links(cls, products):
+        """Return a dictionary of product id to the ids of its raw and main
+        variants.
+
+        The links of the other products in the record cache are fetched at
+        the same time.
+        """
+        pool = Pool()
+        ProductRawProduct = pool.get('product.product-product.raw_product')
+        ids = {p.id for p in products if p.id is not None and p.id >= 0}
+        for product in products:
+            ids.update(i for i in product._local_cache.keys() if i >= 0)
+        return ProductRawProduct.get_links(ids)
+
+    @classmethod
+    def _audit_raw_products_queries(cls):
+        """Return the kind, the from clause, the product id column and the
+        condition of each inconsistency of the raw variants
+        """
+        pool = Pool()
+        ProductRawProduct = pool.get('product.product-product.raw_product')
+        Template = pool.get('product.template')
+        table = cls.__table__()
+        main = cls.__table__()
+        link = ProductRawProduct.__table__()
+        template = Template.__table__()
+
+        has_raw_products = Coalesce(table.has_raw_products, Literal(False))
+        is_raw_product = Coalesce(table.is_raw_product, Literal(False))
+        template_has_raw_products = Coalesce(
+            template.has_raw_products, Literal(False))
+        code = cls._raw_code_column(table)
+        with_template = table.join(template,
+            condition=table.template == template.id)
+        return [
+            ('has_raw_products_mismatch', with_template, table.id,
+                has_raw_products != template_has_raw_products),
+            ('unexpected_raw_product', with_template, table.id,
+                (table.is_raw_product == Literal(True))
+                & ~template_has_raw_products),
+            ('template_mismatch',
+                link.join(table, condition=link.raw_product == table.id
+                    ).join(main, condition=link.product == main.id),
+                table.id, table.template != main.template),
+            ('missing_raw_product',
+                with_template.join(link, 'LEFT',
+                    condition=link.product == table.id),
+                table.id,
+                template_has_raw_products & ~is_raw_product
+                & (link.id == Null)),
+            ('code_mismatch', with_template, table.id,
+                template_has_raw_products
+                & ((table.code != code) | (table.code == Null))),
+            ]
+
+    @classmethod
+    def audit_raw_products(cls, batch_size=None):
+        """Yield (kind, product id) for each inconsistency of the raw variants
+
+        Each kind is found by one query read by batches of batch_size ids so
+        the findings can be repaired while they are streamed.
+        """
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+
+        if batch_size is None:
+            batch_size = transaction.database.IN_MAX
+        for kind, from_, column, where in cls._audit_raw_products_queries():
+            last_id = 0
+            while True:
+                cursor.execute(*from_.select(column,
+                        where=where & (column > last_id),
+                        order_by=[column.asc],
+                        limit=batch_size))
+                ids = [i for i, in cursor]
+                if not ids:
+                    break
+                last_id = ids[-1]
+                for product_id in ids:
+                    yield kind, product_id
+
+    @classmethod
+    def repair_raw_products(cls, findings=None, batch_size=None):
+        """Repair by batches the findings of audit_raw_products
+
+        The raw variants on templates without raw variants are only logged
+        as they may be used. Return the number of findings repaired by kind.
+        """
+        pool = Pool()
+        Template = pool.get('product.template')
+        table = cls.__table__()
+        template = Template.__table__()
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+
+        if batch_size is None:
+            batch_size = transaction.database.IN_MAX
+        if findings is None:
+            findings = cls.audit_raw_products(batch_size=batch_size)
+        findings = iter(findings)
+        repaired = defaultdict(int)
+        while True:
+            batch = defaultdict(list)
+            for kind, product_id in islice(findings, batch_size):
+                batch[kind].append(product_id)
+            if not batch:
+                break
+
+            if batch['has_raw_products_mismatch']:
+                cursor.execute(*table.update(
+                        [table.has_raw_products],
+                        [template.select(
+                                Coalesce(template.has_raw_products,
+                                    Literal(False)),
+                                where=template.id == table.template)],
+                        where=reduce_ids(
+                            table.id, batch['has_raw_products_mismatch'])))
+                clear_cache(cls)
+            for product_id in batch['unexpected_raw_product']:
+                logger.warning(
+                    "Raw product %d on a template without raw products",
+                    product_id)
+            if batch['template_mismatch']:
+                links = cls.get_raw_links(
+                    cls.browse(batch['template_mismatch']))
+                main_products = cls.browse(
+                    [links[i][1] for i in batch['template_mismatch']])
+                to_write = defaultdict(list)
+                for raw_product_id, main_product in zip(
+                        batch['template_mismatch'], main_products):
+                    to_write[main_product.template.id].append(raw_product_id)
+                args = []
+                for template_id, raw_product_ids in to_write.items():
+                    args.extend((cls.browse(raw_product_ids), {
+                                'template': template_id,
+                                }))
+                cls.write(*args)
+            if batch['missing_raw_product']:
+                cls.create_raw_products(
+                    cls.browse(batch['missing_raw_product']))
+            if batch['code_mismatch']:
+                cls.sync_raw_code(cls.browse(batch['code_mismatch']))
+
+            for kind, product_ids in batch.items():
+                if kind != 'unexpected_raw_product':
+                    repaired[kind] += len(product_ids)
+            logger.info("Repaired %d raw product findings",
+                sum(repaired.values()))
+        return dict(repaired)
 
 
 class ProductRawProduct(ModelSQL):
@@ -356,3 +1184,145 @@ class ProductRawProduct(ModelSQL):
             ('raw_product_unique', Unique(t, t.raw_product),
                 'product_raw_variant.msg_raw_product_unique'),
             ]
+        cls._sql_indexes.update({
+                Index(t,
+                    (t.product, Index.Equality()),
+                    (t.raw_product, Index.Equality())),
+                Index(t,
+                    (t.raw_product, Index.Equality()),
+                    (t.product, Index.Equality())),
+                })
+
+    @classmethod
+    def on_modification(cls, mode, records, field_names=None):
+        super().on_modification(mode, records, field_names=field_names)
+        cls._links_cache().clear()
+
+    @classmethod
+    def _links_cache(cls):
+        "Return the links read in the current transaction"
+        return transaction_cache(cls.__name__)
+
+    @classmethod
+    def get_links(cls, product_ids):
+        "Return a dictionary of product id to (raw variant id, main variant id)"
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+
+        cache = cls._links_cache()
+        links = {}
+        missing = []
+        for product_id in product_ids:
+            link = cache.get(product_id)
+            if link is None:
+                missing.append(product_id)
+            else:
+                links[product_id] = link
+        for sub_ids in grouped_slice(missing):
+            sub_links = {i: [None, None] for i in sub_ids}
+            cursor.execute(*table.select(table.product, table.raw_product,
+                    where=reduce_ids(table.product, sub_links)
+                    | reduce_ids(table.raw_product, sub_links)))
+            for product_id, raw_product_id in cursor:
+                if product_id in sub_links:
+                    sub_links[product_id][0] = raw_product_id
+                if raw_product_id in sub_links:
+                    sub_links[raw_product_id][1] = product_id
+            for product_id, link in sub_links.items():
+                links[product_id] = cache[product_id] = tuple(link)
+        return links
+
+    @classmethod
+    def export_pairs(cls, templates=None, batch_size=None):
+        """Yield a dictionary for each main variant and its raw variant
+
+        The pairs are read by batches of batch_size links in the order of the
+        links so the memory used does not depend on the number of pairs.
+        """
+        pool = Pool()
+        Product = pool.get('product.product')
+        Template = pool.get('product.template')
+        table = cls.__table__()
+        main = Product.__table__()
+        raw = Product.__table__()
+        template = Template.__table__()
+        cursor = Transaction().connection.cursor()
+
+        if batch_size is None:
+            batch_size = Transaction().database.IN_MAX
+        query = table.join(main, condition=table.product == main.id
+            ).join(raw, condition=table.raw_product == raw.id
+            ).join(template, condition=main.template == template.id)
+        where = Literal(True)
+        if templates is not None:
+            where &= reduce_ids(main.template, [t.id for t in templates])
+        columns = [
+            'template', 'template_code',
+            'product', 'product_code', 'product_suffix_code',
+            'raw_product', 'raw_product_code', 'raw_product_suffix_code',
+            ]
+        last_id = 0
+        while True:
+            cursor.execute(*query.select(table.id,
+                    main.template, template.code,
+                    main.id, main.code, main.suffix_code,
+                    raw.id, raw.code, raw.suffix_code,
+                    where=where & (table.id > last_id),
+                    order_by=[table.id.asc],
+                    limit=batch_size))
+            rows = cursor.fetchall()
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            for row in rows:
+                yield dict(zip(columns, row[1:]))
+
+    @classmethod
+    def _import_pair_values(cls, pair):
+        "Return the values to create the main and raw variants of the pair"
+        main_values = {
+            'template': pair['template'],
+            'suffix_code': pair.get('product_suffix_code'),
+            }
+        raw_values = {
+            'template': pair['template'],
+            'suffix_code': pair.get('raw_product_suffix_code',
+                main_values['suffix_code']),
+            'is_raw_product': True,
+            }
+        return main_values, raw_values
+
+    @classmethod
+    def import_pairs(cls, pairs, batch_size=None):
+        """Create the main and raw variants of the pairs with their links
+
+        pairs is an iterable of dictionaries like those of export_pairs which
+        is consumed by batches of batch_size pairs. Each batch creates its
+        variants and its links at once. Return the number of pairs created.
+        """
+        pool = Pool()
+        Product = pool.get('product.product')
+
+        if batch_size is None:
+            batch_size = Transaction().database.IN_MAX
+        pairs = iter(pairs)
+        count = 0
+        with Transaction().set_context(no_create_raw_products=True):
+            while True:
+                values = [cls._import_pair_values(p)
+                    for p in islice(pairs, batch_size)]
+                if not values:
+                    break
+                products = Product.create(
+                    [m for m, _ in values] + [r for _, r in values])
+                main_products = products[:len(values)]
+                raw_products = products[len(values):]
+                cls.create([{
+                            'product': main.id,
+                            'raw_product': raw.id,
+                            } for main, raw in zip(
+                            main_products, raw_products)])
+                Product.validate(main_products)
+                count += len(values)
+                logger.info("Imported %d raw product pairs", count)
+        return count
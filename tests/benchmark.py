@@ -0,0 +1,362 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+"""Benchmarks of the product_raw_variant module
+
+Run them against a SQLite database with:
+
+    python -O -m trytond.modules.product_raw_variant.tests.benchmark
+
+The -O flag skips the assertions of trytond, which are quadratic on the
+number of instances and hide the time spent by the module.
+
+Each measure is printed as one JSON object per line with the name of the
+benchmark, the number of records, the number of SQL statements and the
+duration in seconds. The output of a previous run can be given with
+--compare to fail when the number of statements of a measure has grown.
+The modules extending the products of the deployment can be activated with
+--module to measure their cost.
+"""
+import argparse
+import json
+import sys
+import time
+
+from trytond.pool import Pool
+from trytond.tests.test_tryton import activate_module, with_transaction
+from trytond.transaction import Transaction
+
+SIZES = [10, 100, 1000, 10000]
+
+
+class Measure(object):
+    "Time and count the SQL statements of a block"
+
+    def __init__(self, name, size):
+        self.name = name
+        self.size = size
+        self.queries = 0
+        self.duration = 0.
+
+    def _trace(self, statement):
+        self.queries += 1
+
+    def __enter__(self):
+        Transaction().connection.set_trace_callback(self._trace)
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.duration = time.perf_counter() - self._start
+        Transaction().connection.set_trace_callback(None)
+
+    def dump(self, output):
+        output.write(json.dumps(self.result) + '\n')
+        output.flush()
+
+    @property
+    def result(self):
+        return {
+            'name': self.name,
+            'size': self.size,
+            'queries': self.queries,
+            'duration': round(self.duration, 6),
+            }
+
+
+def setup_configuration():
+    pool = Pool()
+    Configuration = pool.get('product.configuration')
+
+    config = Configuration(1)
+    config.raw_product_prefix = 'RAW'
+    config.main_product_prefix = 'MAIN'
+    config.save()
+
+
+def template_values(name, variants, **values):
+    pool = Pool()
+    Uom = pool.get('product.uom')
+    unit, = Uom.search([('name', '=', 'Unit')])
+
+    values.setdefault('has_raw_products', True)
+    return dict({
+            'name': name,
+            'type': 'goods',
+            'default_uom': unit.id,
+            'products': [('create', [{
+                            'suffix_code': '%s-%s' % (name, i),
+                            } for i in range(variants)])],
+            }, **values)
+
+
+@with_transaction()
+def bench_template_getters(size, output):
+    "Compare the per-instance walk with Template.get_products"
+    pool = Pool()
+    Template = pool.get('product.template')
+
+    setup_configuration()
+    templates = Template.create([template_values('T%s' % i, 2)
+            for i in range(size)])
+    ids = [t.id for t in templates]
+
+    with Measure('template_getters_instance', size) as measure:
+        for template in Template.browse(ids):
+            [p.id for p in template.products if not p.is_raw_product]
+            [p.id for p in template.products if p.is_raw_product]
+    measure.dump(output)
+
+    with Measure('template_getters', size) as measure:
+        Template.read(ids, ['main_products', 'raw_products'])
+    measure.dump(output)
+
+
+def create_template(size, **values):
+    pool = Pool()
+    Template = pool.get('product.template')
+
+    template, = Template.create([template_values('T', size, **values)])
+    return template
+
+
+@with_transaction()
+def bench_template_create(size, output):
+    "Template.create with the creation of the missing raw variants"
+    pool = Pool()
+    Template = pool.get('product.template')
+
+    setup_configuration()
+    values = template_values('T', size)
+    with Measure('template_create', size) as measure:
+        with Transaction().set_context(no_create_raw_products=True):
+            Template.create([values])
+    measure.dump(output)
+
+
+@with_transaction()
+def bench_product_create(size, output):
+    "Product.create with the creation of the raw variants"
+    pool = Pool()
+    Product = pool.get('product.product')
+
+    setup_configuration()
+    template = create_template(0)
+    vlist = [{
+            'template': template.id,
+            'suffix_code': str(i),
+            } for i in range(size)]
+    with Measure('product_create', size) as measure:
+        Product.create(vlist)
+    measure.dump(output)
+
+
+@with_transaction()
+def bench_sync_code(size, output):
+    "Product.sync_code after a change of prefix"
+    pool = Pool()
+    Configuration = pool.get('product.configuration')
+    Product = pool.get('product.product')
+
+    setup_configuration()
+    template = create_template(size)
+    config = Configuration(1)
+    config.raw_product_prefix = 'R'
+    config.main_product_prefix = 'M'
+    config.save()
+    products = Product.browse(template.products)
+    with Measure('sync_code', size) as measure:
+        Product.sync_code(products)
+    measure.dump(output)
+
+
+@with_transaction()
+def bench_product_write(size, output):
+    "Product.write of the suffix code of main variants"
+    pool = Pool()
+    Product = pool.get('product.product')
+
+    setup_configuration()
+    template = create_template(size)
+    products = Product.browse(template.main_products)
+    args = []
+    for product in products:
+        args.extend(([product], {'suffix_code': 'W' + product.suffix_code}))
+    with Measure('product_write', size) as measure:
+        Product.write(*args)
+    measure.dump(output)
+
+
+@with_transaction()
+def bench_template_copy(size, output):
+    "Template.copy of a template with raw variants"
+    pool = Pool()
+    Template = pool.get('product.template')
+
+    setup_configuration()
+    template = create_template(size)
+    with Measure('template_copy', size) as measure:
+        Template.copy([template])
+    measure.dump(output)
+
+    with Measure('template_copy_raw_products', size) as measure:
+        with Transaction().set_context(copy_raw_products=True):
+            Template.copy([template], {
+                    'products.suffix_code': lambda d: 'C' + d['suffix_code'],
+                    })
+    measure.dump(output)
+
+
+@with_transaction()
+def bench_template_delete(size, output):
+    "Template.delete of a template with raw variants"
+    pool = Pool()
+    Template = pool.get('product.template')
+
+    setup_configuration()
+    template = create_template(size)
+    with Measure('template_delete', size) as measure:
+        Template.delete([template])
+    measure.dump(output)
+
+
+@with_transaction()
+def bench_product_delete(size, output):
+    "Product.delete of main variants with their raw variants"
+    pool = Pool()
+    Product = pool.get('product.product')
+
+    setup_configuration()
+    template = create_template(size)
+    products = Product.browse(template.main_products)
+    with Measure('product_delete', size) as measure:
+        Product.delete(products)
+    measure.dump(output)
+
+
+@with_transaction()
+def bench_export_import_pairs(size, output):
+    "Export the pairs of a template and import them on another one"
+    pool = Pool()
+    Product = pool.get('product.product')
+    ProductRawProduct = pool.get('product.product-product.raw_product')
+
+    setup_configuration()
+    template = create_template(size)
+    other = create_template(0)
+    with Measure('export_pairs', size) as measure:
+        pairs = list(ProductRawProduct.export_pairs(templates=[template]))
+    measure.dump(output)
+
+    for pair in pairs:
+        pair['template'] = other.id
+    Product.delete(Product.browse(template.main_products))
+    with Measure('import_pairs', size) as measure:
+        ProductRawProduct.import_pairs(iter(pairs))
+    measure.dump(output)
+
+
+@with_transaction()
+def bench_audit_raw_products(size, output):
+    "Product.audit_raw_products on a consistent catalogue"
+    pool = Pool()
+    Product = pool.get('product.product')
+
+    setup_configuration()
+    create_template(size)
+    with Measure('audit_raw_products', size) as measure:
+        for _ in Product.audit_raw_products():
+            pass
+    measure.dump(output)
+
+
+@with_transaction()
+def bench_on_change_has_raw_products(size, output):
+    "size calls of Template.on_change_has_raw_products without raw variants"
+    pool = Pool()
+    Template = pool.get('product.template')
+
+    template = Template(has_raw_products=False)
+    with Measure('on_change_has_raw_products', size) as measure:
+        for _ in range(size):
+            template.products = []
+            template.on_change_has_raw_products()
+    measure.dump(output)
+
+
+BENCHMARKS = [
+    bench_template_getters,
+    bench_template_create,
+    bench_product_create,
+    bench_sync_code,
+    bench_product_write,
+    bench_template_copy,
+    bench_template_delete,
+    bench_product_delete,
+    bench_export_import_pairs,
+    bench_audit_raw_products,
+    bench_on_change_has_raw_products,
+    ]
+
+
+def compare(results, reference):
+    "Return the measures with more queries than in reference"
+    reference = {(r['name'], r['size']): r['queries'] for r in reference}
+    regressions = []
+    for result in results:
+        queries = reference.get((result['name'], result['size']))
+        if queries is not None and result['queries'] > queries:
+            regressions.append((result, queries))
+    return regressions
+
+
+class _Collector(object):
+    "Write the measures to output and keep them"
+
+    def __init__(self, output):
+        self.output = output
+        self.results = []
+
+    def write(self, line):
+        self.output.write(line)
+        self.results.append(json.loads(line))
+
+    def flush(self):
+        self.output.flush()
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', dest='sizes', type=int, action='append',
+        help='number of records (default: %s)' % SIZES)
+    parser.add_argument('--benchmark', dest='benchmarks', action='append',
+        choices=[b.__name__ for b in BENCHMARKS])
+    parser.add_argument('--output', type=argparse.FileType('w'),
+        default=sys.stdout)
+    parser.add_argument('--compare', type=argparse.FileType('r'),
+        help='JSON lines of a previous run')
+    parser.add_argument('--module', dest='modules', action='append',
+        default=[], help='module to activate in addition')
+    options = parser.parse_args(arguments)
+
+    activate_module(['product_raw_variant'] + options.modules)
+    output = _Collector(options.output)
+    for benchmark in BENCHMARKS:
+        if options.benchmarks and benchmark.__name__ not in options.benchmarks:
+            continue
+        for size in options.sizes or SIZES:
+            benchmark(size, output)
+
+    if options.compare:
+        reference = [json.loads(l) for l in options.compare if l.strip()]
+        regressions = compare(output.results, reference)
+        for result, queries in regressions:
+            sys.stderr.write('%s[%s]: %s queries instead of %s\n' % (
+                    result['name'], result['size'], result['queries'],
+                    queries))
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -2,8 +2,33 @@
 # This file is part of Tryton.  The COPYRIGHT file at the top level of
 # this repository contains the full copyright notices and license terms.
 
+import re
+from contextlib import contextmanager
+from unittest.mock import patch
+import unittest
+
+from trytond import backend
+from trytond.exceptions import UserError
 from trytond.tests.test_tryton import ModuleTestCase, with_transaction
 from trytond.pool import Pool
+from trytond.transaction import Transaction
+
+from trytond.modules.product_raw_variant import product as product_module
+
+
+@contextmanager
+def count_queries():
+    "Count the SQL statements executed on the SQLite connection"
+    counter = [0]
+
+    def trace(statement):
+        counter[0] += 1
+    connection = Transaction().connection
+    connection.set_trace_callback(trace)
+    try:
+        yield counter
+    finally:
+        connection.set_trace_callback(None)
 
 
 class ProductRawVariantTestCase(ModuleTestCase):
@@ -53,4 +78,935 @@ class ProductRawVariantTestCase(ModuleTestCase):
         template = Template(template.id)
         self.assertEqual(len(template.raw_products), 1)
 
+    @unittest.skipIf(backend.name != 'sqlite', 'query count uses sqlite3')
+    @with_transaction()
+    def test0020_raw_variant_batch_creation(self):
+        pool = Pool()
+        Configuration = pool.get('product.configuration')
+        Template = pool.get('product.template')
+        Product = pool.get('product.product')
+        Uom = pool.get('product.uom')
+
+        config = Configuration(1)
+        config.raw_product_prefix = 'RAW'
+        config.main_product_prefix = 'MAIN'
+        config.save()
+        unit, = Uom.search([('name', '=', 'Unit')])
+
+        template, = Template.create([{
+                    'name': 'Test Product Raw',
+                    'type': 'goods',
+                    'cost_price_method': 'fixed',
+                    'default_uom': unit.id,
+                    'has_raw_products': True,
+                    }])
+        with count_queries() as single:
+            Product.create([{
+                        'template': template.id,
+                        'suffix_code': '00',
+                        }])
+        with count_queries() as batch:
+            Product.create([{
+                        'template': template.id,
+                        'suffix_code': '%02d' % i,
+                        } for i in range(1, 11)])
+        self.assertLess(batch[0], 2 * single[0])
+
+        template = Template(template.id)
+        self.assertEqual(len(template.main_products), 11)
+        self.assertEqual(len(template.raw_products), 11)
+        for product in template.main_products:
+            self.assertEqual(product.code, 'MAIN' + product.suffix_code)
+            self.assertEqual(product.raw_product.code,
+                'RAW' + product.suffix_code)
+            self.assertEqual(product.raw_product.main_product, product)
+
+    @with_transaction()
+    def test0030_create_missing_raw_products(self):
+        pool = Pool()
+        Configuration = pool.get('product.configuration')
+        Template = pool.get('product.template')
+        Uom = pool.get('product.uom')
+
+        config = Configuration(1)
+        config.raw_product_prefix = 'RAW'
+        config.main_product_prefix = 'MAIN'
+        config.save()
+        unit, = Uom.search([('name', '=', 'Unit')])
+
+        templates = Template.create([{
+                    'name': 'Test Product Raw %s' % i,
+                    'type': 'goods',
+                    'cost_price_method': 'fixed',
+                    'default_uom': unit.id,
+                    'products': [('create', [{
+                                    'suffix_code': '%s%s' % (i, j),
+                                    } for j in range(3)])],
+                    } for i in range(2)])
+        Template.write(templates, {'has_raw_products': True})
+        self.assertEqual(
+            sum(len(t.raw_products) for t in Template.browse(templates)), 0)
+
+        raw_products = templates[0].create_missing_raw_products()
+        self.assertEqual(len(raw_products), 3)
+        raw_products = Template.bulk_create_missing_raw_products(templates)
+        self.assertEqual(len(raw_products), 3)
+        self.assertEqual(
+            Template.bulk_create_missing_raw_products(templates), [])
+        self.assertEqual(templates[0].create_missing_raw_products(), {})
+        for template in Template.browse(templates):
+            self.assertEqual(len(template.main_products), 3)
+            self.assertEqual(len(template.raw_products), 3)
+            for product in template.main_products:
+                self.assertEqual(product.raw_product.template, template)
+                self.assertEqual(product.raw_product.code,
+                    'RAW' + product.suffix_code)
+
+    @with_transaction()
+    def test0040_has_raw_products_stored(self):
+        pool = Pool()
+        Template = pool.get('product.template')
+        Product = pool.get('product.product')
+        Uom = pool.get('product.uom')
+
+        unit, = Uom.search([('name', '=', 'Unit')])
+        template, other = Template.create([{
+                    'name': 'Test Product %s' % i,
+                    'type': 'goods',
+                    'cost_price_method': 'fixed',
+                    'default_uom': unit.id,
+                    'products': [('create', [{
+                                    'suffix_code': '%s0' % i,
+                                    }])],
+                    } for i in range(2)])
+        self.assertEqual(
+            Product.search([('has_raw_products', '=', True)]), [])
+
+        Template.write([template], {'has_raw_products': True})
+        product, = Product.search([('has_raw_products', '=', True)])
+        self.assertEqual(product.template, template)
+
+        product, = other.products
+        Product.write([product], {'template': template.id})
+        self.assertEqual(Product(product.id).has_raw_products, True)
+
+    @with_transaction()
+    def test0050_sync_raw_code(self):
+        pool = Pool()
+        Configuration = pool.get('product.configuration')
+        Template = pool.get('product.template')
+        Product = pool.get('product.product')
+        Uom = pool.get('product.uom')
+
+        config = Configuration(1)
+        config.raw_product_prefix = 'RAW'
+        config.save()
+        unit, = Uom.search([('name', '=', 'Unit')])
+        template, = Template.create([{
+                    'name': 'Test Product Raw',
+                    'type': 'goods',
+                    'cost_price_method': 'fixed',
+                    'default_uom': unit.id,
+                    'code': 'T',
+                    'has_raw_products': True,
+                    'main_products': [('create', [{
+                                    'suffix_code': '10',
+                                    }])],
+                    }])
+        main_product, = template.main_products
+        raw_product = main_product.raw_product
+        self.assertEqual(main_product.code, 'T10')
+        self.assertEqual(raw_product.code, 'RAWT10')
+
+        config.prefix_sufix_separator = '-'
+        config.save()
+        Product.sync_raw_code([main_product, raw_product])
+        self.assertEqual(Product(main_product.id).code, 'T-10')
+        self.assertEqual(Product(raw_product.id).code, 'RAWT-10')
+
+        config.main_product_prefix = 'MAIN'
+        config.save()
+        Product.sync_code([main_product, raw_product])
+        self.assertEqual(Product(main_product.id).code, 'MAIN-10')
+        self.assertEqual(Product(raw_product.id).code, 'RAWT-10')
+
+        with Transaction().set_context(product_raw_variant_prefix='X'):
+            Product.sync_code([main_product])
+        self.assertEqual(Product(main_product.id).code, 'XMAIN-10')
+
+        other, = Template.create([{
+                    'name': 'Test Product Raw Other',
+                    'type': 'goods',
+                    'cost_price_method': 'fixed',
+                    'default_uom': unit.id,
+                    'code': 'O',
+                    'has_raw_products': True,
+                    }])
+        with Transaction().set_context(no_create_raw_products=True):
+            Product.create([{
+                        'template': template.id,
+                        'suffix_code': '1',
+                        }])
+            with self.assertRaisesRegex(UserError, 'must be unique'):
+                Product.create([{
+                            'template': other.id,
+                            'suffix_code': '1',
+                            }])
+
+        with patch.object(Configuration, '_sync_raw_codes') as sync:
+            config = Configuration(1)
+            config.main_product_prefix = 'MAIN'
+            config.save()
+            sync.assert_not_called()
+            config.main_product_prefix = 'M'
+            config.save()
+            sync.assert_called_once_with()
+
+    @with_transaction()
+    def test0060_check_raw_products(self):
+        pool = Pool()
+        Configuration = pool.get('product.configuration')
+        Template = pool.get('product.template')
+        Product = pool.get('product.product')
+        ProductRawProduct = pool.get('product.product-product.raw_product')
+        Uom = pool.get('product.uom')
+
+        config = Configuration(1)
+        config.raw_product_prefix = 'RAW'
+        config.save()
+        unit, = Uom.search([('name', '=', 'Unit')])
+        template, = Template.create([{
+                    'name': 'Test Product Raw',
+                    'type': 'goods',
+                    'cost_price_method': 'fixed',
+                    'default_uom': unit.id,
+                    'has_raw_products': True,
+                    'main_products': [('create', [{
+                                    'suffix_code': str(i),
+                                    } for i in range(2)])],
+                    }])
+        Product.check_raw_products(template.products)
+
+        main_product, other_main_product = template.main_products
+        raw_product = main_product.raw_product
+        link, = ProductRawProduct.search([
+                ('product', '=', other_main_product.id),
+                ])
+        ProductRawProduct.delete([link])
+        ProductRawProduct.create([{
+                    'product': raw_product.id,
+                    'raw_product': other_main_product.id,
+                    }])
+        with self.assertRaisesRegex(UserError, 'has a Raw Variant'):
+            Product.check_raw_products([raw_product])
+        with self.assertRaisesRegex(UserError, 'has a Main Variant'):
+            Product.check_raw_products([other_main_product])
+
+        with self.assertRaisesRegex(UserError, 'has a Raw or Main Variant'):
+            Template.write([template], {'has_raw_products': False})
+
+    @unittest.skipIf(backend.name != 'sqlite', 'query count uses sqlite3')
+    @with_transaction()
+    def test0070_raw_links_cache(self):
+        pool = Pool()
+        Configuration = pool.get('product.configuration')
+        Template = pool.get('product.template')
+        Product = pool.get('product.product')
+        Uom = pool.get('product.uom')
+
+        config = Configuration(1)
+        config.raw_product_prefix = 'RAW'
+        config.save()
+        unit, = Uom.search([('name', '=', 'Unit')])
+        template, = Template.create([{
+                    'name': 'Test Product Raw',
+                    'type': 'goods',
+                    'cost_price_method': 'fixed',
+                    'default_uom': unit.id,
+                    'has_raw_products': True,
+                    'main_products': [('create', [{
+                                    'suffix_code': str(i),
+                                    } for i in range(11)])],
+                    }])
+        main_products = Product.browse(template.main_products)
+        raw_products = Product.browse(template.raw_products)
+
+        with count_queries() as queries:
+            links = Product.get_raw_links(main_products + raw_products)
+        self.assertEqual(queries[0], 1)
+        for main_product, raw_product in zip(main_products, raw_products):
+            self.assertEqual(links[main_product.id], (raw_product.id, None))
+            self.assertEqual(links[raw_product.id], (None, main_product.id))
+        with count_queries() as queries:
+            Product.get_raw_links(main_products)
+        self.assertEqual(queries[0], 0)
+
+        ids = [p.id for p in main_products + raw_products]
+        with count_queries() as without_links:
+            Product.read(ids, ['code'])
+        # The links are served from the cache filled by get_raw_links
+        with count_queries() as with_links:
+            values = Product.read(ids, ['code', 'raw_product', 'main_product'])
+        self.assertEqual(with_links[0], without_links[0])
+        values = {v['id']: v for v in values}
+        for main_product, raw_product in zip(main_products, raw_products):
+            self.assertEqual(
+                values[main_product.id]['raw_product'], raw_product.id)
+            self.assertEqual(
+                values[raw_product.id]['main_product'], main_product.id)
+
+        with count_queries() as single:
+            Product.delete(main_products[:1])
+        with count_queries() as batch:
+            Product.delete(main_products[1:])
+        self.assertLess(batch[0], 2 * single[0])
+        self.assertEqual(Product.search([
+                    ('template', '=', template.id),
+                    ]), [])
+
+    @unittest.skipIf(backend.name != 'sqlite', 'query count uses sqlite3')
+    @with_transaction()
+    def test0075_raw_links_cache_size(self):
+        pool = Pool()
+        Configuration = pool.get('product.configuration')
+        Template = pool.get('product.template')
+        Product = pool.get('product.product')
+        ProductRawProduct = pool.get('product.product-product.raw_product')
+        Uom = pool.get('product.uom')
+
+        config = Configuration(1)
+        config.raw_product_prefix = 'RAW'
+        config.save()
+        unit, = Uom.search([('name', '=', 'Unit')])
+        template, = Template.create([{
+                    'name': 'Test Product Raw',
+                    'type': 'goods',
+                    'cost_price_method': 'fixed',
+                    'default_uom': unit.id,
+                    'has_raw_products': True,
+                    'main_products': [('create', [{
+                                    'suffix_code': str(i),
+                                    } for i in range(10)])],
+                    }])
+        products = Product.search([('template', '=', template.id)])
+        # Read more links than the size of a memory cache
+        product_ids = set(range(1, max(p.id for p in products) + 2000))
+
+        links = ProductRawProduct.get_links(product_ids)
+        self.assertEqual(len(links), len(product_ids))
+        with count_queries() as queries:
+            self.assertEqual(ProductRawProduct.get_links(product_ids), links)
+            self.assertEqual(Product.get_raw_links(products), {
+                    p.id: links[p.id] for p in products})
+        self.assertEqual(queries[0], 0)
+
+        Product.delete([p for p in products if links[p.id][0]])
+        self.assertEqual(Product.search([
+                    ('template', '=', template.id),
+                    ]), [])
+        with count_queries() as queries:
+            ProductRawProduct.get_links([products[0].id])
+        self.assertEqual(queries[0], 1)
+
+    @with_transaction()
+    def test0080_delete(self):
+        pool = Pool()
+        Configuration = pool.get('product.configuration')
+        Template = pool.get('product.template')
+        Product = pool.get('product.product')
+        Uom = pool.get('product.uom')
+
+        config = Configuration(1)
+        config.raw_product_prefix = 'RAW'
+        config.save()
+        unit, = Uom.search([('name', '=', 'Unit')])
+        templates = Template.create([{
+                    'name': 'Test Product Raw %s' % i,
+                    'type': 'goods',
+                    'cost_price_method': 'fixed',
+                    'default_uom': unit.id,
+                    'has_raw_products': True,
+                    'main_products': [('create', [{
+                                    'suffix_code': '%s%s' % (i, j),
+                                    } for j in range(3)])],
+                    } for i in range(3)])
+        template = templates.pop(0)
+
+        main_product = template.main_products[0]
+        raw_product = main_product.raw_product
+        with self.assertRaisesRegex(UserError, 'Delete raw variants'):
+            Product.delete([raw_product])
+        Product.delete([raw_product, main_product])
+        self.assertEqual(len(Product.search([
+                        ('template', '=', template.id),
+                        ])), 4)
+
+        Template.delete(templates)
+        self.assertEqual(Product.search([
+                    ('template', 'in', [t.id for t in templates]),
+                    ]), [])
+
+    @with_transaction()
+    def test0090_backfill_raw_products(self):
+        pool = Pool()
+        Queue = pool.get('ir.queue')
+        Configuration = pool.get('product.configuration')
+        Template = pool.get('product.template')
+        Uom = pool.get('product.uom')
+        transaction = Transaction()
+
+        config = Configuration(1)
+        config.raw_product_prefix = 'RAW'
+        config.save()
+        unit, = Uom.search([('name', '=', 'Unit')])
+        templates = Template.create([{
+                    'name': 'Test Product Raw %s' % i,
+                    'type': 'goods',
+                    'cost_price_method': 'fixed',
+                    'default_uom': unit.id,
+                    'products': [('create', [{
+                                    'suffix_code': '%s%s' % (i, j),
+                                    } for j in range(3)])],
+                    } for i in range(2)])
+        Template.write(templates, {'has_raw_products': True})
+        Template.write(templates, {'has_raw_products': True})
+        tasks = Queue.search([])
+        self.assertEqual(len(tasks), 1)
+        self.assertEqual(tasks[0].data['method'], 'backfill_raw_products')
+        self.assertEqual(
+            sorted(tasks[0].data['instances']), [t.id for t in templates])
+
+        with patch.object(transaction, 'commit') as commit:
+            self.assertEqual(
+                Template.backfill_raw_products(batch_size=4), 6)
+            self.assertEqual(commit.call_count, 2)
+            self.assertEqual(Template.backfill_raw_products(), 0)
+        for template in Template.browse(templates):
+            self.assertEqual(len(template.raw_products), 3)
+
+    @unittest.skipIf(backend.name != 'sqlite',
+        'the chunks are only run in the test transaction on SQLite memory')
+    @with_transaction()
+    def test0095_generate_raw_products(self):
+        pool = Pool()
+        Configuration = pool.get('product.configuration')
+        Template = pool.get('product.template')
+        Product = pool.get('product.product')
+        Uom = pool.get('product.uom')
+
+        config = Configuration(1)
+        config.raw_product_prefix = 'RAW'
+        config.save()
+        unit, = Uom.search([('name', '=', 'Unit')])
+        templates = Template.create([{
+                    'name': 'Test Product Raw %s' % i,
+                    'type': 'goods',
+                    'cost_price_method': 'fixed',
+                    'default_uom': unit.id,
+                    'code': 'T%s' % i,
+                    'products': [('create', [{
+                                    'suffix_code': '%s' % j,
+                                    } for j in range(3)])],
+                    } for i in range(3)])
+        # The raw variant of T10 conflicts with the code of this variant
+        Template.create([{
+                    'name': 'Test Product Conflict',
+                    'type': 'goods',
+                    'cost_price_method': 'fixed',
+                    'default_uom': unit.id,
+                    'code': 'RAWT1',
+                    'products': [('create', [{
+                                    'suffix_code': '0',
+                                    }])],
+                    }])
+        Template.write(templates, {'has_raw_products': True})
+
+        # The chunks share the connection of the memory database so each
+        # chunk transaction is emulated by a savepoint
+        create_chunk = product_module._create_missing_raw_products
+        connection = Transaction().connection
+
+        def create_missing_raw_products(*args):
+            connection.cursor().execute('SAVEPOINT chunk')
+            return create_chunk(*args)
+
+        def rollback(transaction):
+            connection.cursor().execute('ROLLBACK TO SAVEPOINT chunk')
+
+        with patch.object(product_module, '_create_missing_raw_products',
+                    create_missing_raw_products), \
+                patch.object(Transaction, 'commit'), \
+                patch.object(Transaction, 'rollback', rollback):
+            report = Template.generate_raw_products(
+                templates, processes=2, chunk_size=1)
+        self.assertEqual(report['templates'], 3)
+        self.assertEqual(report['errors'][0][0], [templates[1].id])
+        self.assertEqual(len(report['errors']), 1)
+        self.assertEqual(report['created'], 6)
+        for template in Template.browse([templates[0], templates[2]]):
+            self.assertEqual(len(template.raw_products), 3)
+        self.assertEqual(Template(templates[1].id).raw_products, ())
+        self.assertEqual(Product.search([
+                    ('template', '=', templates[1].id),
+                    ('is_raw_product', '=', True),
+                    ]), [])
+
+    @with_transaction()
+    def test0097_audit_repair_raw_products(self):
+        pool = Pool()
+        Configuration = pool.get('product.configuration')
+        Template = pool.get('product.template')
+        Product = pool.get('product.product')
+        Uom = pool.get('product.uom')
+        table = Product.__table__()
+        cursor = Transaction().connection.cursor()
+
+        config = Configuration(1)
+        config.raw_product_prefix = 'RAW'
+        config.save()
+        unit, = Uom.search([('name', '=', 'Unit')])
+        template, other, simple = Template.create([{
+                    'name': 'Test Product Raw %s' % i,
+                    'type': 'goods',
+                    'cost_price_method': 'fixed',
+                    'default_uom': unit.id,
+                    'code': 'T%s' % i,
+                    'has_raw_products': i < 2,
+                    'products': [('create', [{
+                                    'suffix_code': '%s' % j,
+                                    } for j in range(3)])],
+                    } for i in range(3)])
+        self.assertEqual(list(Product.audit_raw_products()), [])
+
+        main_product, other_main_product, _ = template.main_products
+        simple_product, unexpected, _ = simple.products
+        cursor.execute(*table.update([table.is_raw_product], [True],
+                where=table.id == unexpected.id))
+
+        def break_raw_products(suffix_code):
+            with Transaction().set_context(no_create_raw_products=True):
+                missing, = Product.create([{
+                            'template': template.id,
+                            'suffix_code': suffix_code,
+                            }])
+            cursor.execute(*table.update([table.template], [other.id],
+                    where=table.id == main_product.raw_product.id))
+            cursor.execute(*table.update([table.code], ['X'],
+                    where=table.id == other_main_product.id))
+            cursor.execute(*table.update([table.has_raw_products], [True],
+                    where=table.id == simple_product.id))
+            return missing
+
+        def check_repaired(missing):
+            self.assertEqual(list(Product.audit_raw_products()), [
+                    ('unexpected_raw_product', unexpected.id),
+                    ])
+            main = Product(main_product.id)
+            self.assertEqual(main.raw_product.template, template)
+            self.assertEqual(main.raw_product.code, 'RAWT00')
+            self.assertEqual(Product(other_main_product.id).code, 'T01')
+            self.assertEqual(Product(simple_product.id).raw_product, None)
+            missing = Product(missing.id)
+            self.assertEqual(
+                missing.raw_product.code, 'RAWT0' + missing.suffix_code)
+
+        missing = break_raw_products('3')
+        findings = list(Product.audit_raw_products(batch_size=1))
+        self.assertEqual(findings, [
+                ('has_raw_products_mismatch', simple_product.id),
+                ('unexpected_raw_product', unexpected.id),
+                ('template_mismatch', main_product.raw_product.id),
+                ('missing_raw_product', missing.id),
+                ('code_mismatch', other_main_product.id),
+                ('code_mismatch', main_product.raw_product.id),
+                ])
+
+        # All the findings are repaired in the same batch
+        with self.assertLogs('trytond.modules.product_raw_variant',
+                'WARNING'):
+            repaired = Product.repair_raw_products()
+        self.assertEqual(repaired, {
+                'has_raw_products_mismatch': 1,
+                'template_mismatch': 1,
+                'missing_raw_product': 1,
+                'code_mismatch': 2,
+                })
+        check_repaired(missing)
+
+        # The findings are audited again after each batch
+        missing = break_raw_products('4')
+        with self.assertLogs('trytond.modules.product_raw_variant',
+                'WARNING'):
+            repaired = Product.repair_raw_products(batch_size=2)
+        self.assertEqual(repaired, {
+                'has_raw_products_mismatch': 1,
+                'template_mismatch': 1,
+                'missing_raw_product': 1,
+                'code_mismatch': 1,
+                })
+        check_repaired(missing)
+
+    @with_transaction()
+    def test0100_measured(self):
+        pool = Pool()
+        Configuration = pool.get('product.configuration')
+        Template = pool.get('product.template')
+        Product = pool.get('product.product')
+        Uom = pool.get('product.uom')
+
+        config = Configuration(1)
+        config.raw_product_prefix = 'RAW'
+        config.save()
+        unit, = Uom.search([('name', '=', 'Unit')])
+        connection = Transaction().connection
+        with Transaction().set_context(product_raw_variant_profile=True), \
+                self.assertLogs('trytond.modules.product_raw_variant',
+                    'INFO') as logs:
+            template, = Template.create([{
+                        'name': 'Test Product Raw',
+                        'type': 'goods',
+                        'cost_price_method': 'fixed',
+                        'default_uom': unit.id,
+                        'has_raw_products': True,
+                        'main_products': [('create', [{
+                                        'suffix_code': str(i),
+                                        } for i in range(3)])],
+                        }])
+        measures = [r.product_raw_variant
+            for r in logs.records if hasattr(r, 'product_raw_variant')]
+        measure, = [m for m in measures
+            if m['name'] == 'product.product.create_raw_products'
+            and m['records']]
+        self.assertEqual(measure['records'], 3)
+        self.assertGreater(measure['queries'], 0)
+        self.assertIs(Transaction().connection, connection)
+        names = {m['name'] for m in measures}
+        self.assertIn('product.product.validate', names)
+        self.assertIn('product.product.sync_code', names)
+
+        if backend.name == 'sqlite':
+            # The trace callback of the connection is kept
+            with count_queries() as queries:
+                with Transaction().set_context(
+                        product_raw_variant_profile=True):
+                    Product.validate(template.products)
+                count = queries[0]
+                Product.search([], limit=1)
+            self.assertGreater(count, 0)
+            self.assertGreater(queries[0], count)
+
+    @with_transaction()
+    def test0110_copy_raw_products(self):
+        pool = Pool()
+        Configuration = pool.get('product.configuration')
+        Template = pool.get('product.template')
+        Product = pool.get('product.product')
+        Uom = pool.get('product.uom')
+
+        config = Configuration(1)
+        config.raw_product_prefix = 'RAW'
+        config.save()
+        unit, = Uom.search([('name', '=', 'Unit')])
+        template, = Template.create([{
+                    'name': 'Test Product Raw',
+                    'type': 'goods',
+                    'cost_price_method': 'fixed',
+                    'default_uom': unit.id,
+                    'code': 'T',
+                    'has_raw_products': True,
+                    'main_products': [('create', [{
+                                    'suffix_code': str(i),
+                                    } for i in range(2)])],
+                    }])
+
+        new_template, = Template.copy([template])
+        self.assertEqual(new_template.products, ())
+
+        with Transaction().set_context(copy_raw_products=True):
+            new_template, = Template.copy([template], {'code': 'C'})
+        new_template = Template(new_template.id)
+        self.assertEqual(len(new_template.main_products), 2)
+        self.assertEqual(len(new_template.raw_products), 2)
+        for product in new_template.main_products:
+            raw_product = product.raw_product
+            self.assertEqual(raw_product.template, new_template)
+            self.assertEqual(raw_product.suffix_code, product.suffix_code)
+            self.assertEqual(raw_product.code, 'RAWC' + product.suffix_code)
+            self.assertEqual(product.code, 'C' + product.suffix_code)
+
+        config.main_product_prefix = 'MAIN'
+        config.save()
+        with Transaction().set_context(copy_raw_products=True):
+            with self.assertRaisesRegex(UserError, 'new suffix code'):
+                Template.copy([template])
+            with patch.object(Product, 'copy', wraps=Product.copy) as copy:
+                new_template, = Template.copy([template], {
+                        'products.suffix_code': (
+                            lambda data: 'N' + data['suffix_code']),
+                        })
+            copy.assert_called_once()
+        new_template = Template(new_template.id)
+        for product in new_template.main_products:
+            self.assertEqual(product.raw_product.main_product, product)
+            self.assertEqual(product.code, 'MAIN' + product.suffix_code)
+        self.assertEqual(
+            sorted(p.suffix_code for p in new_template.main_products),
+            ['N0', 'N1'])
+
+    @unittest.skipIf(backend.name != 'sqlite', 'query count uses sqlite3')
+    @with_transaction()
+    def test0120_raw_variant_prefixes(self):
+        pool = Pool()
+        Configuration = pool.get('product.configuration')
+
+        config = Configuration(1)
+        config.raw_product_prefix = 'RAW'
+        config.save()
+        self.assertEqual(
+            Configuration.get_raw_variant_prefixes(), ('RAW', None, None))
+        with count_queries() as queries:
+            Configuration.get_raw_variant_prefixes()
+        self.assertEqual(queries[0], 0)
+
+        config.main_product_prefix = 'MAIN'
+        config.prefix_sufix_separator = '-'
+        config.save()
+        self.assertEqual(
+            Configuration.get_raw_variant_prefixes(), ('RAW', 'MAIN', '-'))
+
+    @with_transaction()
+    def test0130_indexes(self):
+        pool = Pool()
+        Product = pool.get('product.product')
+        ProductRawProduct = pool.get('product.product-product.raw_product')
+        table = ProductRawProduct.__table__()
+        link_index = (r'COVERING INDEX '
+            r'idx_product_product-product_raw_product_\w+ \(%s>\?\)')
+
+        self.assertIndexScan(table.select(table.product, table.raw_product,
+                where=table.product > 0), 'a', link_index % 'product')
+        self.assertIndexScan(table.select(table.product, table.raw_product,
+                where=table.raw_product > 0), 'a', link_index % 'raw_product')
+        self.assertIndexScan(Product.search([
+                    ('has_raw_products', '=', True),
+                    ], query=True), 'a', r'\(has_raw_products=\?\)')
+
+    @unittest.skipIf(backend.name == 'sqlite',
+        'SQLite does not create the partial index on is_raw_product')
+    @with_transaction()
+    def test0135_raw_products_index(self):
+        pool = Pool()
+        Product = pool.get('product.product')
+
+        self.assertIndexScan(Product.search([
+                    ('template', '=', 1),
+                    ('is_raw_product', '=', True),
+                    ], query=True), 'a')
+
+    @with_transaction()
+    def test0140_sync_raw_products(self):
+        pool = Pool()
+        Configuration = pool.get('product.configuration')
+        Template = pool.get('product.template')
+        Product = pool.get('product.product')
+        Uom = pool.get('product.uom')
+
+        config = Configuration(1)
+        config.raw_product_prefix = 'RAW'
+        config.save()
+        unit, = Uom.search([('name', '=', 'Unit')])
+        template, other = Template.create([{
+                    'name': 'Test Product Raw %s' % i,
+                    'type': 'goods',
+                    'cost_price_method': 'fixed',
+                    'default_uom': unit.id,
+                    'code': 'T%s' % i,
+                    'has_raw_products': True,
+                    'main_products': [('create', [{
+                                    'suffix_code': '%s%s' % (i, j),
+                                    } for j in range(2)])],
+                    } for i in range(2)])
+        main_product, other_main_product = template.main_products
+
+        Product.write([main_product], {'suffix_code': '99'},
+            [other_main_product], {'template': other.id})
+        main_product = Product(main_product.id)
+        self.assertEqual(main_product.raw_product.suffix_code, '99')
+        self.assertEqual(main_product.raw_product.code, 'RAWT099')
+        other_main_product = Product(other_main_product.id)
+        self.assertEqual(other_main_product.raw_product.template, other)
+        self.assertEqual(other_main_product.raw_product.code, 'RAWT101')
+
+    @with_transaction()
+    def test0150_export_import_pairs(self):
+        pool = Pool()
+        Configuration = pool.get('product.configuration')
+        Template = pool.get('product.template')
+        Product = pool.get('product.product')
+        ProductRawProduct = pool.get('product.product-product.raw_product')
+        Uom = pool.get('product.uom')
+
+        config = Configuration(1)
+        config.raw_product_prefix = 'RAW'
+        config.save()
+        unit, = Uom.search([('name', '=', 'Unit')])
+        template, other = Template.create([{
+                    'name': 'Test Product Raw %s' % i,
+                    'type': 'goods',
+                    'cost_price_method': 'fixed',
+                    'default_uom': unit.id,
+                    'code': 'T%s' % i,
+                    'has_raw_products': True,
+                    'main_products': [('create', [{
+                                    'suffix_code': '%s' % j,
+                                    } for j in range(5)])],
+                    } for i in range(2)])
+
+        pairs = list(ProductRawProduct.export_pairs(
+                templates=[template], batch_size=2))
+        self.assertEqual(len(pairs), 5)
+        self.assertEqual(pairs[0], {
+                'template': template.id,
+                'template_code': 'T0',
+                'product': template.main_products[0].id,
+                'product_code': 'T00',
+                'product_suffix_code': '0',
+                'raw_product': template.raw_products[0].id,
+                'raw_product_code': 'RAWT00',
+                'raw_product_suffix_code': '0',
+                })
+
+        Product.delete(Product.browse(template.main_products))
+        count = ProductRawProduct.import_pairs(iter(pairs), batch_size=2)
+        self.assertEqual(count, 5)
+        template = Template(template.id)
+        self.assertEqual(len(template.main_products), 5)
+        self.assertEqual(len(template.raw_products), 5)
+        self.assertEqual(
+            sorted(p.raw_product.code for p in template.main_products),
+            ['RAWT0%s' % j for j in range(5)])
+        self.assertEqual(
+            [p['product_code'] for p in ProductRawProduct.export_pairs(
+                    templates=[template])],
+            ['T0%s' % j for j in range(5)])
+
+    @with_transaction()
+    def test0160_products_search_and_paging(self):
+        pool = Pool()
+        Configuration = pool.get('product.configuration')
+        Template = pool.get('product.template')
+        Uom = pool.get('product.uom')
+
+        config = Configuration(1)
+        config.raw_product_prefix = 'RAW'
+        config.save()
+        unit, = Uom.search([('name', '=', 'Unit')])
+        template, other = Template.create([{
+                    'name': 'Test Product Raw %s' % i,
+                    'type': 'goods',
+                    'cost_price_method': 'fixed',
+                    'default_uom': unit.id,
+                    'code': 'T%s' % i,
+                    'has_raw_products': True,
+                    'main_products': [('create', [{
+                                    'suffix_code': '%s' % j,
+                                    } for j in range(5)])],
+                    } for i in range(2)])
+        simple, = Template.create([{
+                    'name': 'Test Product',
+                    'type': 'goods',
+                    'cost_price_method': 'fixed',
+                    'default_uom': unit.id,
+                    'code': 'S',
+                    'products': [('create', [{
+                                    'suffix_code': '%s' % j,
+                                    } for j in range(2)])],
+                    }])
+        main_ids = [p.id for p in template.main_products]
+        raw_ids = [p.id for p in template.raw_products]
+
+        with Transaction().set_context(
+                product_raw_variant_offset=1, product_raw_variant_limit=2):
+            result = Template.read([template.id, other.id, simple.id],
+                ['main_products', 'raw_products'])
+        self.assertEqual(list(result[0]['main_products']), main_ids[1:3])
+        self.assertEqual(list(result[0]['raw_products']), raw_ids[1:3])
+        self.assertEqual(len(result[1]['main_products']), 2)
+        self.assertEqual(list(result[2]['main_products']), [])
+        with Transaction().set_context(product_raw_variant_offset=4):
+            template = Template(template.id)
+            self.assertEqual(
+                [p.id for p in template.main_products], main_ids[4:])
+
+        for domain, result in [
+                ([('main_products', '=', main_ids[0])], [template]),
+                ([('raw_products', '=', main_ids[0])], []),
+                ([('raw_products', 'in', raw_ids)], [template]),
+                ([('main_products.code', '=', 'T13')], [other]),
+                ([('main_products.code', '=', 'S0')], []),
+                ([('raw_products.code', '=', 'T13')], []),
+                ([('raw_products.code', '=', 'RAWT13')], [other]),
+                ([('raw_products', 'where', [
+                                ('suffix_code', '=', '2'),
+                                ])], [template, other]),
+                ([('main_products', 'not where', [
+                                ('template', '=', template.id),
+                                ])], [other, simple]),
+                ([('main_products', '!=', None)], [template, other]),
+                ([('raw_products', '=', None)], [simple]),
+                ([('main_products', 'not in', main_ids)], [other, simple]),
+                ]:
+            self.assertEqual(
+                Template.search(domain, order=[('id', 'ASC')]), result,
+                msg=domain)
+
+    @with_transaction()
+    def test0170_on_change_has_raw_products(self):
+        pool = Pool()
+        Template = pool.get('product.template')
+        Product = pool.get('product.product')
+
+        template = Template(has_raw_products=False, products=[])
+        with patch.object(Product, 'default_get',
+                wraps=Product.default_get) as default_get:
+            template.on_change_has_raw_products()
+            template.products = []
+            template.on_change_has_raw_products()
+            self.assertEqual(default_get.call_count, 1)
+            with Transaction().set_context(default_suffix_code='X'):
+                template.products = []
+                template.on_change_has_raw_products()
+            self.assertEqual(default_get.call_count, 2)
+        product, = template.products
+        self.assertEqual(product.suffix_code, 'X')
+        self.assertNotIn('id', Product._default_fields_names)
+
+        template.has_raw_products = True
+        template.on_change_has_raw_products()
+        self.assertEqual(list(template.products), [])
+
+    def assertIndexScan(self, query, table, index=None):
+        """Assert that the query reads table through an index
+
+        On SQLite, index is a regular expression searched in the plan line
+        of the table.
+        """
+        cursor = Transaction().connection.cursor()
+        if backend.name == 'sqlite':
+            cursor.execute('EXPLAIN QUERY PLAN ' + str(query), query.params)
+            plan = [r[-1] for r in cursor]
+            self.assertTrue(
+                any(d.startswith('SEARCH %s USING' % table)
+                    and (index is None or re.search(index, d))
+                    for d in plan),
+                plan)
+        else:
+            cursor.execute('SET LOCAL enable_seqscan = off')
+            cursor.execute('EXPLAIN ' + str(query), query.params)
+            plan = [r[0] for r in cursor]
+            self.assertFalse(
+                any(re.search(r'Seq Scan on \S+ %s\b' % table, d)
+                    for d in plan),
+                plan)
+
 del ModuleTestCase